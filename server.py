@@ -1,6 +1,37 @@
+"""
+Fusion PDF + signets (FastAPI / PyMuPDF).
+
+Variables d'environnement :
+  PORT              port d'écoute en lancement direct (défaut 8080)
+  WEB_CONCURRENCY   nombre de workers uvicorn (défaut : nombre de CPU) ;
+                    aussi lu par la CLI uvicorn du Procfile
+  TMPDIR            dossier des fichiers temporaires (PDF téléchargés et fusionné).
+                    Le pointer vers un tmpfs (ex. /dev/shm) garde les catalogues
+                    en RAM et supprime les écritures disque, si la mémoire le permet.
+  PDF_CACHE_DIR     dossier du cache des catalogues (défaut /var/tmp/fusion-pdf-cache,
+                    indépendant de TMPDIR : le cache reste sur disque même si les
+                    temporaires sont en RAM). Sur le même système de fichiers que
+                    TMPDIR, un hit est un lien dur ; sinon une copie.
+  PDF_CACHE_MAX_MB  taille max du cache, éviction LRU (défaut 2048, 0 = désactivé)
+  DOWNLOAD_WORKERS  téléchargements simultanés max par worker (défaut 16)
+"""
 import os
-import io
+import gc
+import json
+import logging
+import asyncio
+import hashlib
+import functools
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # hors POSIX : pas de verrou inter-process
+    fcntl = None
 from urllib.parse import urlsplit
 
 import requests
@@ -16,49 +47,344 @@ import uvicorn
 
 app = FastAPI(title="Fusion PDF + Signets (PyMuPDF)")
 
-# ---------- Téléchargement robuste -> fichier disque ----------
-def download_pdf_to_tempfile(url: str, timeout: int = 600, chunk_size: int = 1024 * 1024) -> str:
-    origin = f"{urlsplit(url).scheme}://{urlsplit(url).netloc}"
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Accept": "application/pdf,*/*;q=0.8",
-        "Referer": origin,
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+# qpdf (C++) concatène en streaming sur disque ; PyMuPDF sert de repli
+QPDF = shutil.which("qpdf")
+
+# ---------- Session HTTP partagée (keep-alive + retries) ----------
+# Une seule session pour tout le process : les connexions TCP/TLS sont
+# réutilisées entre catalogues et entre requêtes.
+_retry = Retry(
+    total=5,
+    backoff_factor=1.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    raise_on_status=False,
+)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=_retry)
+SESSION = requests.Session()
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "application/pdf,*/*;q=0.8",
+})
+
+# Pool dédié aux téléchargements (borné, <= taille du pool HTTP) : le pool par
+# défaut d'asyncio ne fait que min(32, cpu+4) threads et sert aussi aux fusions
+DOWNLOAD_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DOWNLOAD_WORKERS", "16")),
+    thread_name_prefix="fetch",
+)
+
+# ---------- Cache disque des catalogues (ETag / Last-Modified) ----------
+# <sha256(url)>.pdf + <sha256(url)>.json ; revalidé par GET conditionnel,
+# éviction LRU (mtime) au-delà de PDF_CACHE_MAX_MB. 0 désactive le cache.
+CACHE_DIR = os.environ.get("PDF_CACHE_DIR") or "/var/tmp/fusion-pdf-cache"
+CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+def _cache_paths(url: str):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    base = os.path.join(CACHE_DIR, key)
+    return base + ".pdf", base + ".json"
+
+class _CacheLock:
+    """
+    Verrou exclusif par URL (flock : entre threads comme entre workers).
+    acquire() le prend par essais non bloquants depuis l'event loop : une
+    requête qui attend n'occupe pas de slot de DOWNLOAD_POOL et reste
+    annulable. release() peut venir avant la fin du téléchargement, quand
+    aucune entrée ne sera mise en cache.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.pdf_path, self.meta_path = _cache_paths(url)
+        self.lock_path = self.pdf_path[:-len(".pdf")] + ".lock"
+        self.f = None
+
+    async def acquire(self, cancel=None, poll: float = 0.05):
+        """
+        Retourne l'instant où l'attente a commencé si le verrou était tenu
+        par une autre requête, None s'il était libre.
+        """
+        waited_since = None
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        while True:
+            f = open(self.lock_path, "a")
+            try:
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if waited_since is None:
+                            waited_since = time.time()
+                        _check_cancel(cancel, self.url)
+                        await asyncio.sleep(poll)
+                # Le fichier a pu être supprimé (puis recréé) pendant l'attente :
+                # le verrou ne vaut que s'il porte encore sur ce chemin
+                try:
+                    current = os.stat(self.lock_path)
+                except FileNotFoundError:
+                    current = None
+                if current is not None and os.path.samestat(os.fstat(f.fileno()), current):
+                    self.f = f
+                    return waited_since
+            except BaseException:
+                f.close()
+                raise
+            f.close()
+
+    def stored_since(self, t: float) -> bool:
+        # Entrée (re)écrite après t, par la requête qu'on attendait
+        try:
+            return os.stat(self.meta_path).st_mtime >= t
+        except OSError:
+            return False
+
+    def release(self) -> None:
+        f, self.f = self.f, None
+        if f is None:
+            return
+        # Plus d'entrée à protéger : le fichier de verrou part avec elle
+        if not os.path.exists(self.pdf_path):
+            _remove_quietly(self.lock_path)
+        f.close()
+
+def _remove_idle_lock(lock_path: str) -> None:
+    # Seulement si personne ne le tient : sinon c'est le détenteur qui le
+    # supprimera en sortie (release), l'entrée n'existant plus
+    try:
+        with open(lock_path) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(lock_path)
+    except OSError:
+        pass
+
+def _link_or_copy(src: str, dst: str) -> None:
+    # Lien dur si même système de fichiers (pas de copie), sinon copie
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _cache_lookup(url: str):
+    if CACHE_MAX_BYTES <= 0:
+        return None
+    pdf_path, meta_path = _cache_paths(url)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if os.path.getsize(pdf_path) != meta["size"]:
+            return None
+        return meta
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _cache_restore(url: str, tmp_path: str) -> None:
+    pdf_path, _ = _cache_paths(url)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    _link_or_copy(pdf_path, tmp_path)
+    try:
+        os.utime(pdf_path)  # LRU : entrée utilisée récemment
+    except OSError:
+        pass  # évincée juste après le lien : tmp_path reste complet
+
+def _cache_store(url: str, tmp_path: str, etag, last_modified) -> None:
+    if CACHE_MAX_BYTES <= 0 or not (etag or last_modified):
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    pdf_path, meta_path = _cache_paths(url)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    # Remplacement atomique : les liens déjà donnés aux requêtes en cours restent valides
+    _link_or_copy(tmp_path, pdf_path + suffix)
+    os.replace(pdf_path + suffix, pdf_path)
+    meta = {
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "size": os.path.getsize(pdf_path),
     }
-    retry = Retry(
-        total=5,
-        backoff_factor=1.5,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["HEAD", "GET"],
-        raise_on_status=False,
-    )
-    sess = requests.Session()
-    sess.mount("http://", HTTPAdapter(max_retries=retry))
-    sess.mount("https://", HTTPAdapter(max_retries=retry))
+    with open(meta_path + suffix, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + suffix, meta_path)
+    _cache_evict()
+
+def _cache_evict() -> None:
+    entries = []  # (mtime, size, path)
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".pdf"):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        for p in (path, path[:-len(".pdf")] + ".json"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        if fcntl is not None:
+            _remove_idle_lock(path[:-len(".pdf")] + ".lock")
+        total -= size
+        log.info(f"[cache] EVICT {path}")
 
+# ---------- Téléchargement robuste -> fichier disque ----------
+def _remove_quietly(path: str) -> None:
     try:
-        h = sess.head(url, headers=headers, timeout=30, allow_redirects=True)
-        size = int(h.headers.get("Content-Length", 0))
-        if size:
-            print(f"[head] {url} size={size/1024/1024:.1f} MB", flush=True)
-    except Exception:
+        os.remove(path)
+    except OSError:
         pass
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    tmp_path = tmp.name
+def _mktemp(suffix: str = ".pdf") -> str:
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+    tmp.close()
+    return tmp.name
+
+def _fadvise(paths, advice: str) -> None:
+    # Conseil au page cache du noyau (no-op si la plateforme ne le gère pas)
+    advice = getattr(os, advice, None)
+    if advice is None:
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, advice)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+class _ProgressWriter:
+    """
+    Écrit chaque bloc en entier sur un fichier brut (non bufferisé) et logue
+    la progression à chaque palier (seuil, pas de modulo).
+    cancel : threading.Event ; une fois levé, le bloc suivant interrompt la copie.
+    """
+
+    def __init__(self, f, url: str, cancel=None, step: int = 50 * 1024 * 1024):
+        self.f, self.url, self.cancel, self.step = f, url, cancel, step
+        self.next_log_at = step
+        self.written = 0
+
+    def write(self, data) -> int:
+        if self.cancel is not None and self.cancel.is_set():
+            raise RuntimeError("téléchargement annulé")
+        # Un write brut peut être partiel : on boucle jusqu'au bout du bloc
+        view = memoryview(data)
+        while view:
+            view = view[self.f.write(view):]
+        self.written += len(data)
+        if self.written >= self.next_log_at:
+            log.info(f"[fetch] {self.url} ~{self.written/1024/1024:.1f} MB")
+            self.next_log_at += self.step
+        return len(data)
+
+def _check_cancel(cancel, url: str) -> None:
+    if cancel is not None and cancel.is_set():
+        raise HTTPException(status_code=400, detail=f"Téléchargement annulé: {url}")
+
+def _restore_from_cache(url: str, tmp_path: str, cancel=None) -> bool:
+    """
+    tmp_path <- entrée du cache. False si l'entrée elle-même a disparu
+    (évincée entre la lecture des métadonnées et la restauration) : l'origine
+    va bien, il suffit de retélécharger. Toute autre erreur (dossier de la
+    requête déjà supprimé, disque plein pendant la copie) remonte.
+    """
+    _check_cancel(cancel, url)
+    pdf_path, _ = _cache_paths(url)
+    try:
+        _cache_restore(url, tmp_path)
+    except FileNotFoundError as e:
+        if e.filename != pdf_path:
+            raise
+        log.warning(f"[cache] LOST  {url} -> {e}")
+        return False
+    # Lecture anticipée dès maintenant : elle tourne pendant que les
+    # catalogues précédents sont encore en cours de fusion
+    _fadvise([tmp_path], "POSIX_FADV_WILLNEED")
+    return True
+
+def download_pdf_to_tempfile(url: str, tmp_path: str, timeout: int = 600, buffer_size: int = 4 * 1024 * 1024, cancel=None, lock=None, waited_since=None) -> str:
+    # lock : _CacheLock déjà pris par l'appelant, libéré ici en fin de téléchargement
     try:
-        downloaded = 0
-        print(f"[fetch] START {url}", flush=True)
-        with sess.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        return _fetch_to_file(url, tmp_path, timeout, buffer_size, cancel, lock, waited_since)
+    finally:
+        if lock is not None:
+            lock.release()
+
+def _fetch_to_file(url: str, tmp_path: str, timeout: int, buffer_size: int, cancel=None, lock=None, waited_since=None, conditional: bool = True) -> str:
+    _check_cancel(cancel, url)
+    origin = f"{urlsplit(url).scheme}://{urlsplit(url).netloc}"
+    headers = {"Referer": origin}  # User-Agent / Accept : en-têtes de SESSION
+    cached = _cache_lookup(url) if conditional else None
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    # Nouvel inode : tmp_path peut être un lien dur vers une entrée du cache,
+    # qu'un open("wb") tronquerait
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    # Non bufferisé : chaque bloc de copyfileobj part en un seul write(2),
+    # sans recopie dans le tampon de BufferedWriter
+    tmp = open(tmp_path, "wb", buffering=0)
+    try:
+        if cached and waited_since is not None and lock.stored_since(waited_since):
+            # La requête qu'on attendait vient de (re)valider l'entrée : on la
+            # sert directement, sans nouvel aller-retour vers l'origine
+            tmp.close()
+            if not _restore_from_cache(url, tmp_path, cancel):
+                return _fetch_to_file(url, tmp_path, timeout, buffer_size, cancel, lock, conditional=False)
+            log.info(f"[cache] FRESH {url}")
+            return tmp_path
+        log.info(f"[fetch] START {url}")
+        with SESSION.get(url, stream=True, headers=headers, timeout=timeout) as r:
+            if cached and r.status_code == 304:
+                tmp.close()
+                if not _restore_from_cache(url, tmp_path, cancel):
+                    # Entrée évincée (autre URL, autre worker) : GET sans condition
+                    return _fetch_to_file(url, tmp_path, timeout, buffer_size, cancel, lock, conditional=False)
+                log.info(f"[cache] HIT   {url}")
+                return tmp_path
             r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    tmp.write(chunk)
-                    downloaded += len(chunk)
-                    if downloaded % (10 * chunk_size) == 0:
-                        print(f"[fetch] {url} ~{downloaded/1024/1024:.1f} MB", flush=True)
-        tmp.flush(); tmp.close()
-        print(f"[fetch] DONE  {url} total ~{downloaded/1024/1024:.1f} MB", flush=True)
-        return tmp_path
+            etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+            if lock is not None and not (etag or last_modified):
+                # Rien ne sera mis en cache : les requêtes en attente sur cette
+                # URL n'ont aucun 304 à espérer, inutile de les bloquer
+                lock.release()
+            size = int(r.headers.get("Content-Length", 0) or 0)
+            if size:
+                log.info(f"[fetch] {url} size={size/1024/1024:.1f} MB")
+                # Réserve l'espace en une fois (extents contigus) ; seulement si le
+                # corps n'est pas compressé, sinon Content-Length != taille sur disque
+                if hasattr(os, "posix_fallocate") and not r.headers.get("Content-Encoding"):
+                    try:
+                        os.posix_fallocate(tmp.fileno(), 0, size)
+                    except OSError:
+                        pass
+            # Copie socket -> fichier en gros blocs, sans passer par iter_content
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, _ProgressWriter(tmp, url, cancel), length=buffer_size)
+        downloaded = tmp.tell()
+        tmp.truncate(downloaded)  # au cas où le corps reçu est plus court que réservé
+        tmp.close()
+        log.info(f"[fetch] DONE  {url} total ~{downloaded/1024/1024:.1f} MB")
+    except HTTPException:
+        raise
     except Exception as e:
         try:
             tmp.close()
@@ -69,19 +395,50 @@ def download_pdf_to_tempfile(url: str, timeout: int = 600, chunk_size: int = 102
                 os.remove(tmp_path)
         except:
             pass
-        print(f"[fetch] ERROR {url} -> {e}", flush=True)
+        log.error(f"[fetch] ERROR {url} -> {e}")
         raise HTTPException(status_code=400, detail=f"Erreur téléchargement PDF: {e}")
 
+    # Le cache est une optimisation : un échec ici ne doit pas casser la fusion
+    try:
+        _cache_store(url, tmp_path, etag, last_modified)
+    except OSError as e:
+        log.warning(f"[cache] ERROR {url} -> {e}")
+    _fadvise([tmp_path], "POSIX_FADV_WILLNEED")
+    return tmp_path
+
+async def download_pdf(url: str, tmp_path: str, cancel: threading.Event) -> str:
+    # Un seul téléchargement à la fois par URL : les requêtes concurrentes sur
+    # le même catalogue attendent (ici, hors du pool) puis repartent du cache
+    lock, waited_since = None, None
+    if CACHE_MAX_BYTES > 0 and fcntl is not None:
+        lock = _CacheLock(url)
+        try:
+            waited_since = await lock.acquire(cancel)
+        except OSError as e:
+            # Le cache est une optimisation : un échec ici ne doit pas casser la fusion
+            log.warning(f"[cache] ERROR {url} -> {e}")
+            lock = None
+    # Annuler la tâche asyncio n'arrête pas le thread : cancel le fait
+    fetch = functools.partial(download_pdf_to_tempfile, url, tmp_path,
+                              cancel=cancel, lock=lock, waited_since=waited_since)
+    future = DOWNLOAD_POOL.submit(fetch)
+    try:
+        return await asyncio.wrap_future(future)
+    finally:
+        # Jamais démarré (annulé dans la file du pool) : le verrou est à nous
+        if lock is not None and future.cancel():
+            lock.release()
+
 # ---------- Logs ----------
 @app.middleware("http")
 async def log_requests(request, call_next):
     try:
-        print(f"[req] {request.method} {request.url.path}", flush=True)
+        log.info(f"[req] {request.method} {request.url.path}")
         res = await call_next(request)
-        print(f"[res] {request.method} {request.url.path} -> {res.status_code}", flush=True)
+        log.info(f"[res] {request.method} {request.url.path} -> {res.status_code}")
         return res
     except Exception as e:
-        print(f"[err] {request.method} {request.url.path} -> {e}", flush=True)
+        log.error(f"[err] {request.method} {request.url.path} -> {e}")
         raise
 
 # ---------- Santé ----------
@@ -102,17 +459,195 @@ def probe_head():
     return Response(status_code=200)
 
 # ---------- Fusion (PyMuPDF / low-RAM) ----------
+def _run_qpdf(args) -> str:
+    res = subprocess.run([QPDF, *args], capture_output=True, text=True)
+    # code 3 = succès avec avertissements
+    if res.returncode not in (0, 3):
+        raise RuntimeError(f"qpdf a échoué ({res.returncode}): {res.stderr.strip()}")
+    if res.returncode == 3:
+        log.warning(f"[merge] qpdf warnings: {res.stderr.strip()}")
+    return res.stdout
+
+def qpdf_page_count(path: str) -> int:
+    return int(_run_qpdf(["--show-npages", path]))
+
+def concat_qpdf(paths, out_path: str) -> None:
+    # Concat pure : les flux des sources sont recopiés tels quels (ni décodage
+    # ni recompression). Les object streams des sources ne sont pas repris :
+    # avec --empty, qpdf écrit la sortie comme le document vide (sans)
+    args = ["--empty", "--stream-data=preserve", "--pages"]
+    for path in paths:
+        args += [path, "1-z"]
+    args += ["--", out_path]
+    _run_qpdf(args)
+
+def _release_cached(paths) -> None:
+    # DONTNEED commence par écrire les pages sales sur disque : on le réserve
+    # aux entrées liées au cache (qui y vont de toute façon), pas aux
+    # téléchargements purement temporaires que rmtree efface juste après
+    linked = []
+    for path in paths:
+        try:
+            if os.stat(path).st_nlink > 1:
+                linked.append(path)
+        except OSError:
+            pass
+    _fadvise(linked, "POSIX_FADV_DONTNEED")
+
+def _valid_chapitres(fournisseur, chapitres):
+    """
+    Contrôle de forme des chapitres, avant tout téléchargement : les entrées
+    invalides sont ignorées (avertissement), jamais fatales. La borne haute
+    de page (nombre de pages du catalogue) est vérifiée dans _build_toc.
+    """
+    if not isinstance(chapitres, list):
+        log.warning(f"[merge] {fournisseur} chapitres ignorés: {chapitres!r}")
+        return []
+    valides = []
+    for ch in chapitres:
+        if (isinstance(ch, dict) and isinstance(ch.get("titre"), str) and ch["titre"]
+                and isinstance(ch.get("page"), int) and ch["page"] >= 1):
+            valides.append(ch)
+        else:
+            log.warning(f"[merge] {fournisseur} chapitre ignoré: {ch!r}")
+    return valides
+
+def _build_toc(meta):
+    """
+    meta : [(fournisseur, chapitres, page_count), ...] dans l'ordre de fusion,
+    chapitres déjà passés par _valid_chapitres.
+    Retourne la TOC PyMuPDF [ [level, title, page+1], ... ].
+    """
+    page_offset = 0
+    toc = []
+    par_categorie = {}  # categorie -> [ [titre, page+1], ... ]
+    for fournisseur, chapitres, nb in meta:
+        # signet (niveau 1) sur la première page de ce fournisseur
+        toc.append([1, f"📁 {fournisseur}", page_offset + 1])
+        # chapitres (niveau 2), pages relatives au catalogue du fournisseur
+        for ch in chapitres:
+            titre, page = ch["titre"], ch["page"]
+            if page > nb:
+                log.warning(f"[merge] {fournisseur} chapitre ignoré: {ch}")
+                continue
+            toc.append([2, titre, page_offset + page])
+            # categorie devient un titre de signet : seulement une chaîne non vide
+            if isinstance(ch.get("categorie"), str) and ch["categorie"]:
+                par_categorie.setdefault(ch["categorie"], []).append(
+                    [f"{fournisseur} – {titre}", page_offset + page]
+                )
+        log.info(f"[merge] {fournisseur} pages={nb} offset={page_offset}")
+        page_offset += nb
+
+    # Vue transverse : catégorie (niveau 2) -> chapitres de tous les fournisseurs (niveau 3)
+    if par_categorie:
+        premiere_page = next(iter(par_categorie.values()))[0][1]
+        toc.append([1, "🗂️ Navigation par catégorie", premiere_page])
+        for categorie, entrees in par_categorie.items():
+            toc.append([2, categorie, entrees[0][1]])
+            toc.extend([3, titre, page] for titre, page in entrees)
+    return toc
+
+class CatalogueMerger:
+    """
+    Fusion incrémentale : add() chaque catalogue dès qu'il est téléchargé,
+    dans l'ordre des fournisseurs, puis save() -> chemin du PDF fusionné,
+    avec un signet par fournisseur, un sous-signet par chapitre et une
+    navigation par catégorie.
+    optimize : compacte la sortie (garbage + deflate) au prix du temps CPU.
+    """
+
+    def __init__(self, optimize: bool = False):
+        self.optimize = optimize
+        # La sauvegarde incrémentale après qpdf ne peut pas compacter : en mode
+        # optimize on passe par PyMuPDF
+        self.use_qpdf = bool(QPDF) and not optimize
+        # Ouvre un doc de sortie vide. Volontairement séquentiel : PyMuPDF
+        # garde le GIL pendant insert_pdf, des fusions partielles en threads
+        # s'exécuteraient l'une après l'autre et coûteraient en plus une
+        # seconde passe d'insert_pdf pour les assembler.
+        self.out = None if self.use_qpdf else fitz.open()
+        self.meta = []  # (fournisseur, path, chapitres, page_count)
+        # add/save/close sont appelés depuis des threads successifs : le verrou
+        # empêche close() de fermer le doc pendant un insert_pdf encore en cours
+        self._lock = threading.RLock()
+
+    def add(self, fournisseur: str, path: str, chapitres) -> None:
+        with self._lock:
+            # WILLNEED déjà émis à la fin du téléchargement (_fetch_to_file)
+            if self.use_qpdf:
+                # Comptage tout de suite, pendant que les autres catalogues
+                # téléchargent ; qpdf les concatène d'un coup dans save()
+                self.meta.append((fournisseur, path, chapitres, qpdf_page_count(path)))
+                return
+            # une seule ouverture par source : comptage + insertion
+            with fitz.open(path) as src:
+                nb = src.page_count
+                self.out.insert_pdf(src)  # insertion directe, peu de RAM
+            # Entrée consommée : libérer son page cache si elle vient du cache disque
+            _release_cached([path])
+            self.meta.append((fournisseur, path, chapitres, nb))
+
+    def save(self) -> str:
+        with self._lock:
+            # Concat output en écrivant sur disque, mémoire faible
+            out_path = _mktemp()
+            try:
+                if self.use_qpdf:
+                    paths = [path for _, path, _, _ in self.meta]
+                    concat_qpdf(paths, out_path)
+                    _release_cached(paths)
+                    self.out = fitz.open(out_path)
+
+                # Applique la TOC (signets)
+                toc = _build_toc([(f, ch, nb) for f, _, ch, nb in self.meta])
+                if toc:
+                    self.out.set_toc(toc)
+
+                # Pas de ré-ouverture de contrôle après coup : une sortie invalide se
+                # manifeste par une exception ici
+                try:
+                    if self.use_qpdf:
+                        self.out.saveIncr()
+                    elif self.optimize:
+                        self.out.save(out_path, garbage=3, deflate=True)
+                    else:
+                        # Entrées supposées saines : pas de ramasse-miettes ni de
+                        # recompression des flux, sauf si le client demande optimize
+                        self.out.save(out_path, garbage=0, deflate=False)
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail=f"PDF généré invalide: {e}")
+
+                return out_path
+            except Exception:
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+                raise
+            finally:
+                self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+
 @app.post("/fusion-pdf")
-def fusion_pdf(payload: dict):
+async def fusion_pdf(payload: dict):
     """
     payload :
     {
       "catalogues": [
         {"fournisseur":"CEDAM","url":"https://.../cedam.pdf","chapitres":[]},
-        {"fournisseur":"Elios Ceramica","url":"https://.../elios.pdf","chapitres":[]}
+        {"fournisseur":"Elios Ceramica","url":"https://.../elios.pdf","chapitres":[
+          {"titre":"Grès cérame","page":12,"categorie":"Sols"}
+        ]}
       ],
-      "titre_global": "Test Fusion"
+      "titre_global": "Test Fusion",
+      "optimize": false
     }
+    chapitres[].page est relative au catalogue du fournisseur (1 = première page).
+    optimize (défaut false) : sortie plus compacte mais fusion plus lente.
     """
     try:
         catalogues = payload.get("catalogues", [])
@@ -120,86 +655,64 @@ def fusion_pdf(payload: dict):
             raise ValueError("Aucun catalogue fourni.")
 
         titre_global = payload.get("titre_global", "Catalogue fusionné")
+        optimize = bool(payload.get("optimize", False))
+        sources = [
+            (c["fournisseur"], c["url"], _valid_chapitres(c["fournisseur"], c.get("chapitres") or []))
+            for c in catalogues
+        ]
 
-        temp_paths = []
-        meta = []  # (fournisseur, path, page_count)
+        # Entrées dans un dossier propre à la requête : un seul rmtree en sortie,
+        # même en cas d'erreur ; seul le PDF fusionné lui survit
+        workdir = tempfile.mkdtemp(prefix="fusion-pdf-req-")
+        merger = CatalogueMerger(optimize)
+        # Levé en sortie (erreur ou non) : stoppe les téléchargements encore en cours
+        cancel = threading.Event()
         try:
-            # 1) Télécharger sur disque + compter pages
-            for c in catalogues:
-                fournisseur = c["fournisseur"]
-                url = c["url"]
-                print(f"[merge] + {fournisseur} | {url}", flush=True)
-                path = download_pdf_to_tempfile(url)
-                with fitz.open(path) as src:
-                    nb = src.page_count
-                temp_paths.append(path)
-                meta.append((fournisseur, path, nb))
-
-            # 2) Concat output en écrivant sur disque, mémoire faible
-            tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-            out_path = tmp_out.name
-            tmp_out.close()
-
-            # Ouvre un doc de sortie vide
-            out = fitz.open()
-
-            page_offset = 0
-            toc = []  # liste [ [level, title, page+1], ... ]
-            for fournisseur, path, nb in meta:
-                with fitz.open(path) as src:
-                    out.insert_pdf(src)  # insertion directe, peu de RAM
-                # signet (niveau 1) sur la première page de ce fournisseur
-                toc.append([1, f"📁 {fournisseur}", page_offset + 1])
-                print(f"[merge] {fournisseur} pages={nb} offset={page_offset}", flush=True)
-                page_offset += nb
-
-            # Applique la TOC (signets)
-            if toc:
-                out.set_toc(toc)
-
-            # Sauvegarde optimisée
-            out.save(out_path, deflate=True, garbage=3)
-            out.close()
-
-            # Sanity check
-            try:
-                with fitz.open(out_path):
-                    pass
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"PDF généré invalide: {e}")
-
-            # 3) Retourner le fichier et nettoyer
-            def cleanup(paths):
-                for p in paths:
-                    try:
-                        if os.path.exists(p):
-                            os.remove(p)
-                    except:
-                        pass
+            temp_paths = [os.path.join(workdir, f"{i}.pdf") for i in range(len(sources))]
 
-            bg = BackgroundTask(cleanup, temp_paths + [out_path])
-            return FileResponse(
-                path=out_path,
-                media_type="application/pdf",
-                filename="catalogues_fusionnes.pdf",
-                background=bg,
-            )
+            # 1) Télécharger sur disque, tous les catalogues en parallèle, et
+            # 2) fusionner au fil de l'eau (hors event loop) : dès que le
+            # catalogue suivant dans l'ordre est arrivé, il est inséré pendant
+            # que les autres continuent de télécharger
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tasks = []
+                    for (fournisseur, url, _), path in zip(sources, temp_paths):
+                        log.info(f"[merge] + {fournisseur} | {url}")
+                        tasks.append(tg.create_task(download_pdf(url, path, cancel)))
+                    for (fournisseur, _, chapitres), task in zip(sources, tasks):
+                        path = await task
+                        await asyncio.to_thread(merger.add, fournisseur, path, chapitres)
+            except ExceptionGroup as eg:
+                raise eg.exceptions[0]
 
+            out_path = await asyncio.to_thread(merger.save)
         finally:
-            # Si erreur avant FileResponse, nettoyer inputs
-            if temp_paths:
-                for p in temp_paths:
-                    try:
-                        if os.path.exists(p):
-                            os.remove(p)
-                    except:
-                        pass
+            cancel.set()
+            # Attend un éventuel add() en cours (verrou) avant de fermer ;
+            # unlink de gros fichiers : hors de l'event loop aussi
+            await asyncio.to_thread(merger.close)
+            await asyncio.to_thread(shutil.rmtree, workdir, ignore_errors=True)
+
+        # 3) Retourner le fichier (sendfile) et le supprimer une fois envoyé
+        bg = BackgroundTask(_remove_quietly, out_path)
+        return FileResponse(
+            path=out_path,
+            media_type="application/pdf",
+            filename="catalogues_fusionnes.pdf",
+            background=bg,
+        )
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# Objets de démarrage (modules, app, routes) -> génération permanente : le
+# ramasse-miettes ne les re-parcourt plus à chaque collecte pendant les fusions
+gc.freeze()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run("server:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools")